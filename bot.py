@@ -139,22 +139,36 @@ if __name__ == "__main__":
 
     settings = BotSettings()
 
-    updater = Updater(settings.telegram.bot_token)
+    updater = Updater(
+        settings.telegram.bot_token,
+        workers=settings.telegram.workers,
+        request_kwargs={"con_pool_size": settings.telegram.con_pool_size},
+    )
     responder = Responder(settings, updater.bot.link)
 
     h = updater.dispatcher.add_handler
     eh = updater.dispatcher.add_error_handler
 
-    h(CommandHandler("start", start))
+    # handlers querying the database or the source run in the worker pool,
+    # so that a slow request doesn't block updates from other users
+    h(CommandHandler("start", start, run_async=True))
     h(CommandHandler("help", help))
-    h(CommandHandler("menu", menu))
-    h(InlineQueryHandler(inline_query))
-    h(CallbackQueryHandler(search_settings_callback, pattern=r"SETTINGS"))
-    h(CallbackQueryHandler(tables_callback, pattern=r"TABLE:.*"))
-    h(CallbackQueryHandler(home_callback, pattern=r"^HOME"))
-    h(CallbackQueryHandler(class_callback, pattern=r"CLASS:.*"))
-    h(CallbackQueryHandler(class_info_callback, pattern=r"CLASSINFO:.*"))
-    h(CallbackQueryHandler(level_callback, pattern=r"LEVEL:.*"))
+    h(CommandHandler("menu", menu, run_async=True))
+    h(InlineQueryHandler(inline_query, run_async=True))
+    h(
+        CallbackQueryHandler(
+            search_settings_callback, pattern=r"SETTINGS", run_async=True
+        )
+    )
+    h(CallbackQueryHandler(tables_callback, pattern=r"TABLE:.*", run_async=True))
+    h(CallbackQueryHandler(home_callback, pattern=r"^HOME", run_async=True))
+    h(CallbackQueryHandler(class_callback, pattern=r"CLASS:.*", run_async=True))
+    h(
+        CallbackQueryHandler(
+            class_info_callback, pattern=r"CLASSINFO:.*", run_async=True
+        )
+    )
+    h(CallbackQueryHandler(level_callback, pattern=r"LEVEL:.*", run_async=True))
     h(CallbackQueryHandler(pass_callback, pattern=r"^PASS$"))
     eh(error)
 
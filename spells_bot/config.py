@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Optional
 
 from pydantic import BaseSettings, BaseModel
 
@@ -15,6 +16,10 @@ class StorageSettings(BaseModel):
 
 class TelegramSettings(BaseModel):
     bot_token: str
+    # threads running blocking handlers
+    workers: int = 8
+    # keep-alive connections to the bot api shared by all handlers
+    con_pool_size: int = 32
 
 
 class DataSourceSettings(BaseModel):
@@ -29,6 +34,9 @@ class HctiSettings(BaseModel):
     user_id: str
     api_key: str
     css_file: Path
+    # id of a stored template with css_file styles and "{{{html}}}" body,
+    # if set, images are rendered from it instead of sending css with every request
+    template_id: Optional[str] = None
 
 
 class BotSettings(BaseSettings):
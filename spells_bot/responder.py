@@ -1,7 +1,7 @@
-import json
-from typing import Dict, Union
+from typing import Dict, Union, Iterable, Generator, Tuple
 from uuid import uuid4
 
+import orjson
 from telegram import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -16,6 +16,8 @@ from spells_bot.config import BotSettings
 from spells_bot.search import SpellSearch
 
 
+TEXT_ENDING = " <i>... продолжение по ссылке</i>"
+
 school_translation = {
     "преграждения": "abjuration",
     "воплощения": "conjuration",
@@ -34,6 +36,39 @@ def _school_ru2en(full_ru_name: str) -> str:
     return school_translation[ru_name]
 
 
+def _truncate_parts(
+    parts: Iterable[str], limit: int, ending: str, sep: str = "\n"
+) -> str:
+    """Join ``parts`` with ``sep`` cutting off the text at ``limit`` characters.
+
+    Parts are consumed lazily, so the remaining ones are never built once the limit is reached.
+
+    :param parts: iterable of text parts
+    :param limit: max length of the resulting text
+    :param ending: appended to the text if it was cut off
+    :param sep: separator between parts
+    :return:
+    """
+    text_parts = []
+    length = -len(sep)
+
+    for part in parts:
+        text_parts.append(part)
+        length += len(sep) + len(part)
+        if length >= limit:
+            cutoff = limit - len(ending)
+            return sep.join(text_parts)[:cutoff] + ending
+
+    return sep.join(text_parts)
+
+
+def _iter_spell_text_parts(spell_ext, school: str) -> Generator[str, None, None]:
+    yield f"<b>{spell_ext.full_name.upper()}</b>"
+    yield f"{school}\n"
+    yield "\n".join(f"<b>{k}</b>: {v}" for k, v in spell_ext.variables.items())
+    yield f"\n{spell_ext.text}"
+
+
 def _book_alias_to_readable_name(book_alias: str) -> str:
     words = []
     current_word = ""
@@ -78,18 +113,19 @@ class Responder:
             settings.db, settings.storage, settings.source, settings.hcti
         )
         self.bot_url_root = bot_url_root.rstrip("/")
+        self._book_button_cache: Dict[str, Tuple[str, str]] = {}
+
+        icon_url_prefix = settings.storage.image_storage_url_root.rstrip("/")
+        self._school_icons = {
+            school: f"{icon_url_prefix}/schoolicons/{school}.jpg"
+            for school in school_translation.values()
+        }
+        self._settings_icon = settings.storage.settings_icon_url
 
     def _spell_url(self, spell_id: str):
         prefix = self._settings.source.spell_info_url_prefix.rstrip("/")
         return f"{prefix}/{spell_id}"
 
-    def _school_icon_url(self, school: str):
-        prefix = self._settings.storage.image_storage_url_root.rstrip("/")
-        return f"{prefix}/schoolicons/{school}.jpg"
-
-    def _settings_icon_url(self):
-        return f"{self._settings.storage.settings_icon_url}"
-
     def _bot_url(self, payload: str = None):
         url = f"{self.bot_url_root}"
         if payload:
@@ -104,17 +140,30 @@ class Responder:
 
     @staticmethod
     def encode_callback(cmd: Union[int, str], *payload: Union[int, str]):
-        return ":".join(str(i) for i in [cmd, *payload])
+        return ":".join(map(str, (cmd, *payload)))
+
+    def _book_button_template(self, book: str) -> Tuple[str, str]:
+        """Return readable name and callback data of a book filter button
+
+        :param book: alias name in camelCase
+        :return:
+        """
+        try:
+            return self._book_button_cache[book]
+        except KeyError:
+            template = (
+                _book_alias_to_readable_name(book),
+                self.encode_callback("SETTINGS", book),
+            )
+            self._book_button_cache[book] = template
+            return template
 
     def _book_filter_markup(self, book_filter: Dict[str, bool]):
-
         book_filter_buttons = []
         for book, value in book_filter.items():
-            icon = "☑" if value else "☐"
-            book_readable_name = _book_alias_to_readable_name(book)
+            name, callback_data = self._book_button_template(book)
             btn = InlineKeyboardButton(
-                f"{book_readable_name} {icon}",
-                callback_data=self.encode_callback("SETTINGS", book),
+                f"{name} {'☑' if value else '☐'}", callback_data=callback_data
             )
             book_filter_buttons.append(btn)
 
@@ -158,23 +207,13 @@ class Responder:
             description = f"{class_restrictions}\n{spell.short_description}"
 
             if spell_ext:
+                text_parts = _iter_spell_text_parts(spell_ext, school)
+            else:
                 text_parts = [
-                    f"<b>{spell_ext.full_name.upper()}</b>",
-                    f"{school}\n",
-                    "\n".join(f"<b>{k}</b>: {v}" for k, v in spell_ext.variables.items()),
-                    f"\n{spell_ext.text}",
+                    f"<b>{title.upper()}</b>\n",
+                    "Невозможно загрузить данные с сайта, смотрите описание заклинания по ссылке",
                 ]
-                text = "\n".join(text_parts)
-            else:
-                text = (
-                    f"<b>{title.upper()}</b>\n\n"
-                    "Невозможно загрузить данные с сайта, смотрите описание заклинания по ссылке"
-                )
-
-            if len(text) >= MAX_MESSAGE_LENGTH:
-                text_ending = " <i>... продолжение по ссылке</i>"
-                cutoff = MAX_MESSAGE_LENGTH - len(text_ending)
-                text = text[:cutoff] + text_ending
+            text = _truncate_parts(text_parts, MAX_MESSAGE_LENGTH, TEXT_ENDING)
 
             buttons = []
             buttons.append(
@@ -193,12 +232,12 @@ class Responder:
                                 callback_data=self.encode_callback("TABLE", spell.alias),
                             )
                         )
-            except json.decoder.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 pass
 
             if spell_ext:
                 en_school_name = _school_ru2en(spell_ext.school)
-                thumb_url = self._school_icon_url(en_school_name)
+                thumb_url = self._school_icons[en_school_name]
             else:
                 thumb_url = None
 
@@ -216,7 +255,7 @@ class Responder:
 
         chat_settings = self.search.get_chat_settings(chat_id)
         current_book_filter = [
-            _book_alias_to_readable_name(k)
+            self._book_button_template(k)[0]
             for k, v in chat_settings.book_filter.items()
             if v
         ]
@@ -231,7 +270,7 @@ class Responder:
                 f"Настройте фильтр для чата {chat_id}"
             ),
             reply_markup=self._book_filter_markup(chat_settings.book_filter),
-            thumb_url=self._settings_icon_url(),
+            thumb_url=self._settings_icon,
         )
         articles.append(settings_article)
         return dict(results=articles)
@@ -260,7 +299,7 @@ class Responder:
                 f"{class_restrictions}"
             )
             m = InputMediaPhoto(
-                t.path.open("rb"),
+                t.path.read_bytes(),
                 caption=caption,
                 parse_mode=ParseMode.HTML,
             )
@@ -288,12 +327,10 @@ class Responder:
     def menu(self, chat_id: int):
         text = "📖 <b>МЕНЮ</b> 🔮\n\nВыберите класс"
         buttons = [
-            InlineKeyboardButton(
-                c.name, callback_data=self.encode_callback("CLASS", c.id)
-            )
+            InlineKeyboardButton(c.name, callback_data=f"CLASS:{c.id}")
             for c in self.search.iter_classes(chat_id)
         ]
-        button_rows = [buttons[i : i + 3] for i in range(0, len(buttons) + 1, 3)]
+        button_rows = [buttons[i : i + 3] for i in range(0, len(buttons), 3)]
 
         return dict(
             text=text,
@@ -307,9 +344,7 @@ class Responder:
         text = f"<b>{c.name}</b>\n\n<i>{c.short_description}</i>"
         buttons = []
         for lvl in self.search.iter_levels(int(class_id)):
-            b = InlineKeyboardButton(
-                lvl, callback_data=self.encode_callback("LEVEL", c.id, lvl, 0)
-            )
+            b = InlineKeyboardButton(lvl, callback_data=f"LEVEL:{c.id}:{lvl}:0")
             buttons.append(b)
 
         class_info_button = InlineKeyboardButton(
@@ -319,7 +354,7 @@ class Responder:
             "🔮 Назад в меню", callback_data=self.encode_callback("HOME")
         )
 
-        button_rows = [buttons[i : i + 5] for i in range(0, len(buttons) + 1, 5)]
+        button_rows = [buttons[i : i + 5] for i in range(0, len(buttons), 5)]
         has_tables = len(list(self.search.iter_class_info_tables(int(class_id)))) > 0
         if tables_button and has_tables:
             button_rows.insert(0, [class_info_button])
@@ -347,7 +382,7 @@ class Responder:
                 f"<b>{class_info.name.upper()}</b> <i>таблица {int(p.stem) + 1}</i>"
             )
             m = InputMediaPhoto(
-                p.open("rb"),
+                p.read_bytes(),
                 caption=caption,
                 parse_mode=ParseMode.HTML,
             )
@@ -380,30 +415,26 @@ class Responder:
             if page >= 1:
                 b = InlineKeyboardButton(
                     f"<< Страница {page}",
-                    callback_data=self.encode_callback(
-                        "LEVEL", class_id, level, page - 1
-                    ),
+                    callback_data=f"LEVEL:{class_id}:{level}:{page - 1}",
                 )
                 pagination_buttons.append(b)
             if page < n_pages - 1:
                 b = InlineKeyboardButton(
                     f"Страница {page + 2} >>",
-                    callback_data=self.encode_callback(
-                        "LEVEL", class_id, level, page + 1
-                    ),
+                    callback_data=f"LEVEL:{class_id}:{level}:{page + 1}",
                 )
                 pagination_buttons.append(b)
 
         for lvl in self.search.iter_levels(class_id):
             b_text = lvl
-            b_callback_data = self.encode_callback("LEVEL", class_id, lvl, 0)
+            b_callback_data = f"LEVEL:{class_id}:{lvl}:0"
             if lvl == level:
                 b_text = "🔘"
                 b_callback_data = "PASS"
             b = InlineKeyboardButton(b_text, callback_data=b_callback_data)
             buttons.append(b)
 
-        button_rows = [buttons[i : i + 5] for i in range(0, len(buttons) + 1, 5)]
+        button_rows = [buttons[i : i + 5] for i in range(0, len(buttons), 5)]
 
         if pagination_buttons:
             button_rows.insert(0, pagination_buttons)
@@ -1,21 +1,39 @@
+from functools import lru_cache
+from threading import Lock
 from typing import List, Generator, Optional, Dict, Iterable, Union, Tuple
 
+import orjson
+from cachetools import TTLCache
 from sqlalchemy import (
     create_engine,
+    event,
     Column,
     Integer,
     String,
     Boolean,
     ForeignKey,
-    update,
+    Index,
     and_,
     asc,
+    func,
+    select,
+    bindparam,
     UnicodeText,
+    text,
+    insert,
+    delete,
 )
-from sqlalchemy.dialects.sqlite import JSON
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import JSON, insert as sqlite_insert
+from sqlalchemy.engine import Engine, Row, URL, make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.orm import (
+    sessionmaker,
+    relationship,
+    Session,
+    joinedload,
+    selectinload,
+)
+from sqlalchemy.pool import QueuePool
 
 from spells_bot.config import DatabaseSettings
 from spells_bot.search.sourcing.datatypes import (
@@ -34,6 +52,9 @@ logger = create_logger("database")
 
 Base = declarative_base()
 
+# rows fetched at once by list queries
+STREAM_BATCH_SIZE = 200
+
 
 class ShortSpellInfoRecord(Base):
     __tablename__ = "short_spell_info"
@@ -53,6 +74,8 @@ class ShortSpellInfoRecord(Base):
         "ExtendedSpellInfoRecord", back_populates="short_spell_info", uselist=False
     )
 
+    __table_args__ = (Index("ix_spell_book_name", "book_alias", "name"),)
+
 
 class ExtendedSpellInfoRecord(Base):
     __tablename__ = "extended_spell_info"
@@ -117,22 +140,202 @@ class ChatSettingsRecord(Base):
     book_filter = Column(JSON)
 
 
-def init_db(sqlalchemy_database_url: str, drop: bool = False) -> sessionmaker:
-    """Create sqlalchemy sessionmaker
+def _json_serializer(obj) -> str:
+    """Serialize json columns with orjson allowing int keys, e.g. in class restrictions
+
+    :param obj: json column value
+    :return:
+    """
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+# statements reused by lookups, so that their compiled form is taken from the cache
+SELECT_SPELL_BY_ALIAS = select(ShortSpellInfoRecord).where(
+    ShortSpellInfoRecord.alias == bindparam("alias")
+)
+SELECT_FULL_SPELL_BY_ALIAS = SELECT_SPELL_BY_ALIAS.options(
+    joinedload(ShortSpellInfoRecord.extended_spell_info).selectinload(
+        ExtendedSpellInfoRecord.tables
+    )
+)
+SELECT_SPELL_ID_BY_ALIAS = select(ShortSpellInfoRecord.id).where(
+    ShortSpellInfoRecord.alias == bindparam("alias")
+)
+SELECT_EXTENDED_SPELL_ID = select(ExtendedSpellInfoRecord.id).where(
+    ExtendedSpellInfoRecord.short_spell_info_id == bindparam("spell_id")
+)
+SELECT_EXTENDED_SPELL_BY_ID = (
+    select(ExtendedSpellInfoRecord)
+    .where(ExtendedSpellInfoRecord.id == bindparam("id"))
+    .options(selectinload(ExtendedSpellInfoRecord.tables))
+)
+# plain column projections for list views, which don't need orm objects
+_spell_columns = ShortSpellInfoRecord.__table__.c
+BASIC_SHORT_SPELL_INFO_COLUMNS = (
+    _spell_columns.alias,
+    _spell_columns.short_description_components,
+    _spell_columns.book_abbreviation,
+    _spell_columns.book_alias,
+    _spell_columns.short_description,
+    _spell_columns.name,
+    _spell_columns.is_race_spell,
+)
+SHORT_SPELL_INFO_COLUMNS = (
+    *BASIC_SHORT_SPELL_INFO_COLUMNS,
+    _spell_columns.schools,
+    _spell_columns.classes,
+)
+SELECT_CLASS_BY_ID = select(ClassRecord).where(ClassRecord.id == bindparam("class_id"))
+SELECT_CHAT_SETTINGS_BY_CHAT_ID = select(ChatSettingsRecord).where(
+    ChatSettingsRecord.chat_id == bindparam("chat_id")
+)
+
+# flips a single existing key of the stored filter in place; sqlite 3.35+ for RETURNING
+TOGGLE_BOOK_FILTER = text(
+    "UPDATE chat_settings SET book_filter = json_set("
+    "book_filter, :path, "
+    "json(CASE WHEN json_extract(book_filter, :path) THEN 'false' ELSE 'true' END)"
+    ") WHERE chat_id = :chat_id AND json_type(book_filter, :path) IS NOT NULL "
+    "RETURNING book_filter"
+)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA foreign_keys=ON",
+)
+# journal mode is persistent and is set by the writer, read-only connections can't change it
+SQLITE_READER_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+)
+SQLITE_READER_POOL_SIZE = 8
+
+
+def _sqlite_pragmas_setter(pragmas: Tuple[str, ...]):
+    """Create a connect event listener executing ``pragmas``
+
+    :param pragmas: PRAGMA statements
+    :return:
+    """
+
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return set_sqlite_pragmas
+
+
+def _create_sqlite_functions(dbapi_connection, connection_record):
+    """Register python functions on every new connection.
+
+    Builtin sqlite ``lower()`` handles ascii only, so cyrillic spell names
+    are lowercased with ``unicode_lower()`` instead
+
+    :param dbapi_connection: raw sqlite3 connection
+    :param connection_record: unused
+    :return:
+    """
+    dbapi_connection.create_function("unicode_lower", 1, str.lower, deterministic=True)
+
+
+def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+    """Stop pysqlite from emitting its own BEGIN, so that ``_begin_immediate`` can do it
+
+    :param dbapi_connection: raw sqlite3 connection
+    :param connection_record: unused
+    :return:
+    """
+    dbapi_connection.isolation_level = None
+
+
+def _begin_immediate(conn):
+    """Take the write lock when a transaction begins rather than on its first write,
+    so that a busy database fails fast instead of in the middle of a transaction
+
+    :param conn: sqlalchemy connection
+    :return:
+    """
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def _create_engine(sqlalchemy_database_url: Union[str, URL], **kwargs) -> Engine:
+    return create_engine(
+        sqlalchemy_database_url,
+        json_serializer=_json_serializer,
+        json_deserializer=orjson.loads,
+        query_cache_size=1200,
+        **kwargs,
+    )
+
+
+def init_db(
+    sqlalchemy_database_url: str, drop: bool = False
+) -> Tuple[sessionmaker, sessionmaker]:
+    """Create sqlalchemy sessionmakers for writing and for reading.
+
+    A file-based sqlite database gets a single writer connection which begins transactions
+    with ``BEGIN IMMEDIATE`` and a pool of read-only connections, so that readers
+    don't wait for writers in WAL mode. Other databases share one engine.
 
     :param sqlalchemy_database_url: currently tested only against sqlite
     :param drop: drop existing and recreate database if True
-    :return:
+    :return: writer and reader sessionmakers
     """
-    engine = create_engine(sqlalchemy_database_url)
-    session_callable = sessionmaker(bind=engine)
+    url = make_url(sqlalchemy_database_url)
+    is_sqlite = url.get_backend_name() == "sqlite"
+    is_sqlite_file = is_sqlite and url.database not in (None, "", ":memory:")
+
+    if is_sqlite_file:
+        writer_engine = _create_engine(
+            url,
+            poolclass=QueuePool,
+            pool_size=1,
+            max_overflow=0,
+            connect_args={"check_same_thread": False},
+        )
+        event.listen(writer_engine, "connect", _create_sqlite_functions)
+        event.listen(writer_engine, "connect", _sqlite_pragmas_setter(SQLITE_PRAGMAS))
+        event.listen(writer_engine, "connect", _disable_pysqlite_transactions)
+        event.listen(writer_engine, "begin", _begin_immediate)
+    else:
+        writer_engine = _create_engine(url)
+        if is_sqlite:
+            event.listen(writer_engine, "connect", _create_sqlite_functions)
 
     if drop:
-        Base.metadata.drop_all(bind=engine)
-
-    Base.metadata.create_all(bind=engine)
+        Base.metadata.drop_all(bind=writer_engine)
+
+    Base.metadata.create_all(bind=writer_engine)
+    # create_all skips existing tables, so add indexes declared after they were created
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=writer_engine, checkfirst=True)
+
+    if is_sqlite_file:
+        reader_engine = _create_engine(
+            url.set(
+                database=f"file:{url.database}",
+                query={**url.query, "mode": "ro", "uri": "true"},
+            ),
+            poolclass=QueuePool,
+            pool_size=SQLITE_READER_POOL_SIZE,
+            connect_args={"check_same_thread": False},
+        )
+        event.listen(reader_engine, "connect", _create_sqlite_functions)
+        event.listen(
+            reader_engine, "connect", _sqlite_pragmas_setter(SQLITE_READER_PRAGMAS)
+        )
+    else:
+        reader_engine = writer_engine
 
-    return session_callable
+    return sessionmaker(bind=writer_engine), sessionmaker(bind=reader_engine)
 
 
 class Database:
@@ -140,42 +343,60 @@ class Database:
 
     Private methods are basic reusable functions which must accept ``db: Session`` as their first argument
 
-    Public methods must always instantiate sessions as ``with self._db() as db: ...``
+    Public methods must always instantiate sessions as ``with self._db_ro() as db: ...`` for reading
+    and ``with self._db_rw() as db: ...`` for writing
 
     """
     def __init__(self, settings: DatabaseSettings, drop_on_startup: bool = False):
         self._settings = settings
-        self._db = init_db(settings.sqlalchemy_url, drop_on_startup)
+        self._db_rw, self._db_ro = init_db(settings.sqlalchemy_url, drop_on_startup)
+
+        # registry lookups, invalidated in create_or_update_registry
+        self._class_cache: Optional[Dict[int, dict]] = None
+        self._school_cache: Optional[Dict[int, SchoolInfo]] = None
+        # restrictions are read-only and shared by all spells with the same class level
+        self._restriction_cache: Dict[Tuple[int, int], ClassInfoSpellRestriction] = {}
+        # cache key of registry queries, bumped in create_or_update_registry
+        self._registry_version = 0
+        self._rulebooks_cached = lru_cache(maxsize=64)(self._load_rulebooks)
+        self._classes_cached = lru_cache(maxsize=64)(self._load_classes)
+        # enabled books per chat, rewritten in update_book_filter
+        self._book_filter_cache: Dict[int, Tuple[str, ...]] = TTLCache(
+            maxsize=10000, ttl=60
+        )
+        self._book_filter_lock = Lock()
 
     @staticmethod
-    def _create_or_update_registry_item(
+    def _upsert_registry_items(
         db: Session,
         db_item_type,
-        item: Union[ShortSpellInfo, ClassInfo, SchoolInfo],
-        where_db: str,
-        where_item: str,
+        items: Iterable[Union[ShortSpellInfo, ClassInfo, SchoolInfo]],
+        index_element: str,
     ):
-        """Wrapper over try: add, except not unique: update existing
+        """Insert items or update existing ones with a single executemany
+        of ``INSERT ... ON CONFLICT DO UPDATE``. Doesn't commit
 
         :param db: sqlalchemy session
-        :param db_item_type: database class for this item
-        :param item: an instance of pydantic model
-        :param where_db: name of database item attribute for equality comparison
-        :param where_item: name of pydantic item attribute for equality comparison
+        :param db_item_type: database class for these items
+        :param items: instances of pydantic model
+        :param index_element: name of unique database column to detect conflicts on
         :return:
         """
-        try:
-            db.add(db_item_type(**item.to_orm()))
-            db.commit()
-        except IntegrityError:
-            db.rollback()
-            stmt_update = (
-                update(db_item_type)
-                .where(getattr(db_item_type, where_db) == getattr(item, where_item))
-                .values(item.to_orm())
-            )
-            db.execute(stmt_update)
-            db.commit()
+        rows = [item.to_orm() for item in items]
+        if not rows:
+            return
+
+        # one prepared statement stepped for every row, no per-batch sql compilation
+        stmt = sqlite_insert(db_item_type)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[index_element],
+            set_={
+                c.name: stmt.excluded[c.name]
+                for c in db_item_type.__table__.columns
+                if c.name in rows[0] and c.name != index_element
+            },
+        )
+        db.execute(stmt, rows)
 
     @staticmethod
     def _iter_classes(
@@ -207,8 +428,7 @@ class Database:
         :param classes: list of ClassInfo items
         :return:
         """
-        for c in classes:
-            Database._create_or_update_registry_item(db, ClassRecord, c, "id", "id")
+        Database._upsert_registry_items(db, ClassRecord, classes, "id")
 
     @staticmethod
     def _iter_schools(db: Session) -> Generator[SchoolInfo, None, None]:
@@ -228,8 +448,7 @@ class Database:
         :param schools: list of SchoolInfo items
         :return:
         """
-        for s in schools:
-            Database._create_or_update_registry_item(db, SchoolRecord, s, "id", "id")
+        Database._upsert_registry_items(db, SchoolRecord, schools, "id")
 
     @staticmethod
     def _create_or_update_spells(db: Session, spells: List[ShortSpellInfo]):
@@ -239,40 +458,54 @@ class Database:
         :param spells: list of ShortSpellInfo items
         :return:
         """
-        for s in spells:
-            Database._create_or_update_registry_item(
-                db, ShortSpellInfoRecord, s, "alias", "alias"
-            )
+        Database._upsert_registry_items(db, ShortSpellInfoRecord, spells, "alias")
 
-    @staticmethod
-    def _convert_short_spell_info_rows(db: Session, rows: List[ShortSpellInfoRecord]):
-        """Serialize list of ShortSpellInfoRecord items to list of ShortSpellInfo items.
+    def _registry_maps(
+        self, db: Session
+    ) -> Tuple[Dict[int, dict], Dict[int, SchoolInfo]]:
+        """Return cached mappings of class id to class info kwargs and school id to school info
+
+        :param db: sqlalchemy session, used only if the cache is empty
+        :return:
+        """
+        if self._class_cache is None:
+            self._class_cache = {c.id: c.dict() for c in self._iter_classes(db)}
+        if self._school_cache is None:
+            self._school_cache = {s.id: s for s in self._iter_schools(db)}
+
+        return self._class_cache, self._school_cache
+
+    def _convert_short_spell_info_rows(
+        self, db: Session, rows: Iterable[Union[ShortSpellInfoRecord, Row]]
+    ):
+        """Serialize list of ShortSpellInfoRecord items or rows of ``SHORT_SPELL_INFO_COLUMNS``
+        to list of ShortSpellInfo items.
 
         Since class and school info are stored in a json column as ids,
-        we need to get corresponding class and school info from database
+        we need to get corresponding class and school info
         before we can instantiate a ``ShortSpellInfo`` model
 
         :param db: sqlalchemy session
-        :param rows: list of ShortSpellInfoRecord items
+        :param rows: iterable of ShortSpellInfoRecord items or rows
         :return:
         """
-        id2class = {c.id: c for c in Database._iter_classes(db)}
-        id2school = {s.id: s for s in Database._iter_schools(db)}
+        id2class, id2school = self._registry_maps(db)
+        restriction_cache = self._restriction_cache
 
         for result in rows:
             schools = [id2school[s] for s in result.schools]
             classes = []
             for c, lvl in result.classes.items():
-                class_info = id2class[int(c)]
-                class_info_restriction = ClassInfoSpellRestriction(
-                    **class_info.dict(), level=lvl
-                )
+                key = (int(c), lvl)
+                class_info_restriction = restriction_cache.get(key)
+                if class_info_restriction is None:
+                    class_info_restriction = ClassInfoSpellRestriction.construct(
+                        **id2class[key[0]], level=lvl
+                    )
+                    restriction_cache[key] = class_info_restriction
                 classes.append(class_info_restriction)
 
-            basic_spell_info = BasicShortSpellInfo.from_orm(result)
-            yield ShortSpellInfo(
-                **basic_spell_info.dict(), classes=classes, schools=schools
-            )
+            yield ShortSpellInfo.from_row(result, classes=classes, schools=schools)
 
     @staticmethod
     def _iter_rulebooks(db: Session) -> Generator[str, None, None]:
@@ -281,8 +514,14 @@ class Database:
         :param db: sqlalchemy session
         :return:
         """
-        for book_alias in db.query(ShortSpellInfoRecord.book_alias).distinct():
-            yield book_alias[0]
+        # keep source order explicit: distinct alone follows ix_spell_book_name
+        book_alias = ShortSpellInfoRecord.book_alias
+        stmt = (
+            select(book_alias)
+            .group_by(book_alias)
+            .order_by(func.min(ShortSpellInfoRecord.id))
+        )
+        yield from db.execute(stmt).scalars()
 
     @staticmethod
     def _default_book_filter(book_alias_list: Iterable[str]):
@@ -304,11 +543,9 @@ class Database:
         :param chat_id: chat id
         :return:
         """
-        return (
-            db.query(ChatSettingsRecord)
-            .filter(ChatSettingsRecord.chat_id == chat_id)
-            .first()
-        )
+        return db.execute(
+            SELECT_CHAT_SETTINGS_BY_CHAT_ID, {"chat_id": chat_id}
+        ).scalar_one_or_none()
 
     @staticmethod
     def _create_chat_settings(
@@ -352,19 +589,50 @@ class Database:
 
         return chat_settings
 
-    @staticmethod
-    def _get_book_filter(db: Session, chat_id: int = None) -> List[str]:
+    def _load_rulebooks(self, registry_version: int) -> Tuple[str, ...]:
+        """Return all rulebook aliases. Cached as ``_rulebooks_cached``
+
+        :param registry_version: cache key only
+        :return:
+        """
+        with self._db_ro() as db:
+            return tuple(self._iter_rulebooks(db))
+
+    def _load_classes(
+        self, registry_version: int, book_filter: Tuple[str, ...]
+    ) -> Tuple[ClassInfo, ...]:
+        """Return classes which appear in the ``book_filter``. Cached as ``_classes_cached``
+
+        :param registry_version: cache key only
+        :param book_filter: aliases in camelCase
+        :return:
+        """
+        with self._db_ro() as db:
+            return tuple(self._iter_classes(db, list(book_filter)))
+
+    def _get_book_filter(self, chat_id: int = None) -> List[str]:
         """Return list of enabled book aliases in camelCase.
+        Opens its own sessions, since missing chat settings are created with the writer
 
-        :param db: sqlalchemy session
         :param chat_id: chat id. if not provided, will return all available aliases
         :return:
         """
         if chat_id:
-            chat_settings = Database._get_or_create_chat_settings(db, chat_id)
+            with self._book_filter_lock:
+                cached = self._book_filter_cache.get(chat_id)
+            if cached is not None:
+                return list(cached)
+
+            chat_settings = self.get_or_create_chat_settings(chat_id)
             include_books = [k for k, v in chat_settings.book_filter.items() if v]
+
+            # keep the entry if update_book_filter stored a newer one meanwhile
+            with self._book_filter_lock:
+                include_books = list(
+                    self._book_filter_cache.setdefault(chat_id, tuple(include_books))
+                )
         else:
-            include_books = list(Database._iter_rulebooks(db))
+            include_books = list(self._rulebooks_cached(self._registry_version))
 
         return include_books
 
@@ -375,10 +643,12 @@ class Database:
         :param min_n: min number of spells to return True
         :return:
         """
-        with self._db() as db:
-            short_spell_info_count = db.query(ShortSpellInfoRecord).count()
+        # stops after min_n + 1 rows instead of counting the whole table
+        stmt = select(ShortSpellInfoRecord.id).limit(1).offset(min_n)
+        with self._db_ro() as db:
+            has_more = db.execute(stmt).first() is not None
 
-        return short_spell_info_count > min_n
+        return has_more
 
     def create_or_update_registry(
         self,
@@ -394,40 +664,68 @@ class Database:
         :param schools: list of SchoolInfo objects
         :return:
         """
-        with self._db() as db:
+        with self._db_rw() as db:
             self._create_or_update_classes(db, classes)
             self._create_or_update_schools(db, schools)
             self._create_or_update_spells(db, spells)
+            db.commit()
+
+        self._class_cache = None
+        self._school_cache = None
+        self._restriction_cache = {}
+        self._registry_version += 1
 
     def iter_short_spell_info_by_name(
-        self, name: str, chat_id: int = None
+        self, name: str, chat_id: int = None, limit: int = None
     ) -> Generator[ShortSpellInfo, None, None]:
         """Yield short spell info filtering by name and chat's book filter if chat_id is provided
 
         :param name: spell name in cyrillic
         :param chat_id: if provided and not found in database, will create a default filter
+        :param limit: (optional) max number of spells
         :return:
         """
 
-        with self._db() as db:
-            include_books = self._get_book_filter(db, chat_id)
+        include_books = self._get_book_filter(chat_id)
 
-            rows = (
-                db.query(ShortSpellInfoRecord)
-                .where(ShortSpellInfoRecord.book_alias.in_(include_books))
-                .order_by(asc(ShortSpellInfoRecord.name))
-                .all()
+        stmt = (
+            select(*SHORT_SPELL_INFO_COLUMNS)
+            .where(
+                and_(
+                    func.unicode_lower(ShortSpellInfoRecord.name).contains(
+                        name.lower(), autoescape=True
+                    ),
+                    ShortSpellInfoRecord.book_alias.in_(include_books),
+                )
             )
+            .order_by(asc(ShortSpellInfoRecord.name))
+            .limit(limit)
+        )
 
-            for result in self._convert_short_spell_info_rows(db, rows):
-                if name in result.name.lower():
-                    yield result
+        with self._db_ro() as db:
+            rows = db.execute(stmt).yield_per(STREAM_BATCH_SIZE)
+            yield from self._convert_short_spell_info_rows(db, rows)
 
-    def iter_short_spell_info_by_class_level(
+    @staticmethod
+    def _class_level_condition(
+        class_id: int, spell_level: int, include_books: List[str]
+    ):
+        """Return where clause matching spells of the class level in the given books
+
+        :param class_id: class id
+        :param spell_level: spell circle level
+        :param include_books: enabled book aliases
+        :return:
+        """
+        return and_(
+            ShortSpellInfoRecord.classes[str(class_id)].as_integer() == spell_level,
+            ShortSpellInfoRecord.book_alias.in_(include_books),
+        )
+
+    def count_short_spell_info_by_class_level(
         self, class_id: int, spell_level: int, chat_id: int = None
-    ) -> Generator[ShortSpellInfo, None, None]:
-        """Yield short spell info filtering by class, spell level restriction,
-        and chat's book filter if chat_id is provided
+    ) -> int:
+        """Count spells yielded by ``iter_short_spell_info_by_class_level``
 
         :param class_id: class id
         :param spell_level: spell circle level
@@ -435,23 +733,50 @@ class Database:
         :return:
         """
 
-        with self._db() as db:
-            include_books = self._get_book_filter(db, chat_id)
+        include_books = self._get_book_filter(chat_id)
 
-            rows = (
-                db.query(ShortSpellInfoRecord)
-                .where(
-                    and_(
-                        ShortSpellInfoRecord.classes[str(class_id)].as_integer()
-                        == spell_level,
-                        ShortSpellInfoRecord.book_alias.in_(include_books),
-                    )
-                )
-                .order_by(asc(ShortSpellInfoRecord.name))
-                .all()
-            )
+        stmt = (
+            select(func.count())
+            .select_from(ShortSpellInfoRecord)
+            .where(self._class_level_condition(class_id, spell_level, include_books))
+        )
 
-            yield from self._convert_short_spell_info_rows(db, rows)
+        with self._db_ro() as db:
+            return db.execute(stmt).scalar_one()
+
+    def iter_short_spell_info_by_class_level(
+        self,
+        class_id: int,
+        spell_level: int,
+        chat_id: int = None,
+        limit: int = None,
+        offset: int = 0,
+    ) -> Generator[BasicShortSpellInfo, None, None]:
+        """Yield basic short spell info without classes and schools filtering by class,
+        spell level restriction, and chat's book filter if chat_id is provided
+
+        :param class_id: class id
+        :param spell_level: spell circle level
+        :param chat_id: if provided and not found in database, will create a default filter
+        :param limit: (optional) max number of spells, e.g. page size
+        :param offset: (optional) number of spells to skip, e.g. previous pages
+        :return:
+        """
+
+        include_books = self._get_book_filter(chat_id)
+
+        stmt = (
+            select(*BASIC_SHORT_SPELL_INFO_COLUMNS)
+            .where(self._class_level_condition(class_id, spell_level, include_books))
+            # id breaks ties between equal names, so that pages don't overlap
+            .order_by(asc(ShortSpellInfoRecord.name), asc(ShortSpellInfoRecord.id))
+            .limit(limit)
+            .offset(offset)
+        )
+
+        with self._db_ro() as db:
+            for row in db.execute(stmt).yield_per(STREAM_BATCH_SIZE):
+                yield BasicShortSpellInfo.from_row(row)
 
     def get_class(self, class_id: int) -> ClassInfo:
         """Get class info by id
@@ -459,8 +784,10 @@ class Database:
         :param class_id: class id
         :return:
         """
-        with self._db() as db:
-            c = db.query(ClassRecord).where(ClassRecord.id == class_id).first()
+        with self._db_ro() as db:
+            c = db.execute(
+                SELECT_CLASS_BY_ID, {"class_id": class_id}
+            ).scalar_one_or_none()
         return ClassInfo.from_orm(c)
 
     def iter_classes(self, chat_id: int):
@@ -469,9 +796,8 @@ class Database:
         :param chat_id: chat id
         :return:
         """
-        with self._db() as db:
-            include_books = self._get_book_filter(db, chat_id)
-            yield from self._iter_classes(db, include_books)
+        include_books = self._get_book_filter(chat_id)
+        yield from self._classes_cached(self._registry_version, tuple(include_books))
 
     def iter_levels(self, class_id: int) -> Generator[int, None, None]:
         """Yield all level numbers which appear in spells for the given class id
@@ -479,27 +805,18 @@ class Database:
         :param class_id: class id
         :return:
         """
-        class_id_str = str(class_id)
-        with self._db() as db:
-            rows = (
-                db.query(ShortSpellInfoRecord)
-                .where(ShortSpellInfoRecord.classes[class_id_str].as_integer() >= 0)
-                .all()
-            )
+        level = ShortSpellInfoRecord.classes[str(class_id)].as_integer()
+        stmt = select(level).distinct().where(level >= 0).order_by(level)
 
-            unique_levels = set()
-            for r in rows:
-                unique_levels.add(r.classes[class_id_str])
-
-            yield from unique_levels
+        with self._db_ro() as db:
+            yield from db.execute(stmt).scalars().all()
 
     def iter_rulebooks(self) -> Generator[str, None, None]:
         """Yield rulebook aliases in camelCase
 
         :return:
         """
-        with self._db() as db:
-            yield from self._iter_rulebooks(db)
+        yield from self._rulebooks_cached(self._registry_version)
 
     def get_full_spell_info(
         self, spell_alias: str
@@ -511,12 +828,10 @@ class Database:
         """
         extended_spell_info = None
 
-        with self._db() as db:
-            short_spell_info = (
-                db.query(ShortSpellInfoRecord)
-                .filter(ShortSpellInfoRecord.alias == spell_alias)
-                .first()
-            )
+        with self._db_ro() as db:
+            short_spell_info = db.execute(
+                SELECT_FULL_SPELL_BY_ALIAS, {"alias": spell_alias}
+            ).scalar_one_or_none()
 
             if short_spell_info:
                 extended_spell_info = short_spell_info.extended_spell_info
@@ -551,22 +866,45 @@ class Database:
         :param tables: discovered or created spell tables
         :return:
         """
-        tables = [SpellTableRecord(**t.to_orm()) for t in tables]
+        values = extended_spell_info.to_orm()
 
-        with self._db() as db:
-            short_spell_info = (
-                db.query(ShortSpellInfoRecord)
-                .filter(ShortSpellInfoRecord.alias == spell_alias)
-                .first()
+        with self._db_rw() as db:
+            short_spell_info_id = db.execute(
+                SELECT_SPELL_ID_BY_ALIAS, {"alias": spell_alias}
+            ).scalar_one_or_none()
+
+            # concurrent lookups of the same spell race here, update instead of failing
+            stmt = sqlite_insert(ExtendedSpellInfoRecord).values(
+                **values, short_spell_info_id=short_spell_info_id
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["short_spell_info_id"], set_=values
             )
-            extended_spell_info = ExtendedSpellInfoRecord(
-                **extended_spell_info.to_orm(),
-                tables=tables,
-                short_spell_info=short_spell_info,
+            extended_spell_info_id = db.execute(stmt).inserted_primary_key[0]
+            if short_spell_info_id is not None:
+                # inserted_primary_key is unreliable when the conflict branch ran
+                extended_spell_info_id = db.execute(
+                    SELECT_EXTENDED_SPELL_ID, {"spell_id": short_spell_info_id}
+                ).scalar_one()
+
+            db.execute(
+                delete(SpellTableRecord).where(
+                    SpellTableRecord.extended_spell_info_id == extended_spell_info_id
+                )
             )
-            db.add(extended_spell_info)
+            if tables:
+                db.execute(
+                    insert(SpellTableRecord),
+                    [
+                        {**t.to_orm(), "extended_spell_info_id": extended_spell_info_id}
+                        for t in tables
+                    ],
+                )
             db.commit()
-            db.refresh(extended_spell_info)
+
+            extended_spell_info = db.execute(
+                SELECT_EXTENDED_SPELL_BY_ID, {"id": extended_spell_info_id}
+            ).scalar_one()
             extended_spell_info = ExtendedSpellInfo.from_orm(extended_spell_info)
 
         return extended_spell_info
@@ -577,7 +915,12 @@ class Database:
         :param chat_id: chat id
         :return: existing or new default ChatSettings
         """
-        with self._db() as db:
+        with self._db_ro() as db:
+            chat_settings = self._get_chat_settings(db, chat_id)
+            if chat_settings:
+                return ChatSettings.from_orm(chat_settings)
+
+        with self._db_rw() as db:
             chat_settings = self._get_or_create_chat_settings(db, chat_id)
             chat_settings = ChatSettings.from_orm(chat_settings)
 
@@ -590,20 +933,24 @@ class Database:
         :param book_alias: alias name in camelCase whose value will be toggled
         :return: updated ChatSettings
         """
-        with self._db() as db:
-            chat_settings = self._get_or_create_chat_settings(db, chat_id)
+        params = {"path": f'$."{book_alias}"', "chat_id": chat_id}
+
+        with self._db_rw() as db:
+            book_filter = db.execute(TOGGLE_BOOK_FILTER, params).scalar()
+            # no row means either the chat has no settings yet or the alias is unknown
+            if book_filter is None and not self._get_chat_settings(db, chat_id):
+                self._create_chat_settings(db, chat_id)
+                book_filter = db.execute(TOGGLE_BOOK_FILTER, params).scalar()
+            if book_filter is None:
+                raise KeyError(book_alias)
+            db.commit()
 
-            new_book_filter = chat_settings.book_filter
-            new_book_filter[book_alias] = not new_book_filter[book_alias]
+        chat_settings = ChatSettings(
+            chat_id=chat_id, book_filter=orjson.loads(book_filter)
+        )
 
-            stmt_update = (
-                update(ChatSettingsRecord)
-                .where(ChatSettingsRecord.chat_id == chat_id)
-                .values(book_filter=new_book_filter)
-            )
-            db.execute(stmt_update)
-            db.commit()
-            db.refresh(chat_settings)
-            chat_settings = ChatSettings.from_orm(chat_settings)
+        include_books = tuple(k for k, v in chat_settings.book_filter.items() if v)
+        with self._book_filter_lock:
+            self._book_filter_cache[chat_id] = include_books
 
         return chat_settings
@@ -1,7 +1,7 @@
 from pathlib import Path
 from typing import List, Optional, Dict
 
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 
 
 class OrmSerializableBaseModel(BaseModel):
@@ -11,15 +11,18 @@ class OrmSerializableBaseModel(BaseModel):
     ``.from_orm(...)`` is implemented by default when orm_mode = True
 
     ``.to_orm()`` is implemented for convenience
-    and can be overridden in child models, e.g. to serialize ``Path``s
+    and can be overridden in child models, e.g. to serialize ``Path``s.
+    It returns a shallow copy of field values, so nested models must be serialized by the child
 
     """
 
     class Config:
         orm_mode = True
+        # nested models are never mutated, keep validated instances instead of copies
+        copy_on_model_validation = "none"
 
     def to_orm(self):
-        return self.dict()
+        return dict(self.__dict__)
 
 
 class SpellTable(OrmSerializableBaseModel):
@@ -42,6 +45,17 @@ class ClassInfo(OrmSerializableBaseModel):
     max_spell_lvl: Optional[int]
     parent_class_ids: list
 
+    @validator("alias", pre=True)
+    def _alias_from_null(cls, alias):
+        return alias or ""
+
+    def to_orm(self):
+        d = dict(self.__dict__)
+        # classes missing from the class lists have no alias,
+        # store it as NULL since the unique index allows many of those
+        d["alias"] = self.alias or None
+        return d
+
 
 class ClassInfoSpellRestriction(ClassInfo):
     level: int
@@ -66,6 +80,25 @@ class BasicShortSpellInfo(OrmSerializableBaseModel):
     name: str
     is_race_spell: bool
 
+    @classmethod
+    def from_row(cls, row, **kwargs):
+        """Instantiate from a database row without validation
+
+        :param row: ShortSpellInfoRecord or a row with the same columns
+        :param kwargs: values of the remaining fields
+        :return:
+        """
+        return cls.construct(
+            alias=row.alias,
+            short_description_components=row.short_description_components,
+            book_abbreviation=row.book_abbreviation,
+            book_alias=row.book_alias,
+            short_description=row.short_description,
+            name=row.name,
+            is_race_spell=row.is_race_spell,
+            **kwargs,
+        )
+
 
 class ShortSpellInfo(BasicShortSpellInfo):
     """Part of ShortSpellInfo which cannot be serialized from orm but can be serialized to orm
@@ -79,7 +112,7 @@ class ShortSpellInfo(BasicShortSpellInfo):
         raise NotImplementedError(f"{cls.__name__} should be instantiated with __init__ rather than from_orm")
 
     def to_orm(self):
-        d = self.dict(exclude={"schools", "classes"})
+        d = dict(self.__dict__)
         d["schools"] = [s.id for s in self.schools]
         d["classes"] = {c.id: c.level for c in self.classes}
         return d
@@ -1,7 +1,13 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Union
+from typing import Union, List, Tuple, Set
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from spells_bot.config import HctiSettings
 from spells_bot.utils.log import create_logger
@@ -10,11 +16,35 @@ from spells_bot.search.sourcing.datatypes import SpellTable
 
 logger = create_logger("hcti")
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MAX_WORKERS = 8
+
 
 class HctiApi:
     def __init__(self, settings: HctiSettings):
         self._settings = settings
         self.css = self._load_css(settings.css_file)
+        self._session = self._create_session()
+        # images are never removed by the bot, so a path seen on disk once stays valid
+        self._known_paths: Set[str] = set()
+
+    @staticmethod
+    def _create_session() -> requests.Session:
+        """Create a session which keeps connections to hcti and image hosts alive
+
+        :return:
+        """
+        session = requests.Session()
+
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        return session
 
     @staticmethod
     def _load_css(path):
@@ -23,21 +53,27 @@ class HctiApi:
         return css
 
     def create_image(self, html: str):
-        """Create image via hcti api from html and pre-configured css
+        """Create image via hcti api from html and pre-configured css.
+        If a stored template is configured, only html is sent as its value
 
         :param html: raw html
         :return:
         """
-        data = {
-            "html": html,
-            "css": self.css,
-            "device_scale": 1,
-        }
-        response = requests.post(
-            url=self._settings.url,
-            data=data,
-            auth=(self._settings.user_id, self._settings.api_key),
-        )
+        auth = (self._settings.user_id, self._settings.api_key)
+
+        if self._settings.template_id:
+            response = self._session.post(
+                url=f"{self._settings.url.rstrip('/')}/{self._settings.template_id}",
+                json={"template_values": {"html": html}},
+                auth=auth,
+            )
+        else:
+            data = {
+                "html": html,
+                "css": self.css,
+                "device_scale": 1,
+            }
+            response = self._session.post(url=self._settings.url, data=data, auth=auth)
 
         image_url = None
         try:
@@ -47,9 +83,8 @@ class HctiApi:
 
         return image_url
 
-    @staticmethod
     def download_image(
-        url: str, download_path: Union[Path, str], overwrite: bool = False
+        self, url: str, download_path: Union[Path, str], overwrite: bool = False
     ) -> None:
         """Download image
 
@@ -60,14 +95,23 @@ class HctiApi:
         """
         download_path = Path(download_path)
         if overwrite or not download_path.exists():
+            tmp_path = None
             try:
                 download_path.parent.mkdir(exist_ok=True, parents=True)
-                response = requests.get(url)
-                with open(download_path, "wb") as f:
-                    f.write(response.content)
+                # streamed into a temporary file, so a broken download never
+                # leaves a truncated image at the final path
+                fd, tmp_path = tempfile.mkstemp(dir=download_path.parent, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    with self._session.get(url, stream=True, timeout=30) as response:
+                        response.raise_for_status()
+                        response.raw.decode_content = True
+                        shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+                os.replace(tmp_path, download_path)
                 logger.info(f"Downloaded {url} to {download_path}")
             except Exception as e:
                 logger.error(f"Failed to save {url} to {download_path} because {e}")
+                if tmp_path:
+                    Path(tmp_path).unlink(missing_ok=True)
 
     def find_or_create(self, html: str, path: Union[Path, str, None]):
         """Discover image locally or create and download
@@ -78,9 +122,28 @@ class HctiApi:
         """
         url = None
         path = Path(path)
+        str_path = str(path)
 
-        if not path.is_file():
-            url = self.create_image(html)
-            self.download_image(url, path)
+        if str_path not in self._known_paths:
+            if not path.is_file():
+                url = self.create_image(html)
+                self.download_image(url, path)
+            # failed renders or downloads are retried on the next lookup
+            if path.is_file():
+                self._known_paths.add(str_path)
 
         return SpellTable(html=html, url=url, path=path)
+
+    def find_or_create_many(
+        self, items: List[Tuple[str, Union[Path, str, None]]]
+    ) -> List[SpellTable]:
+        """Discover or create images concurrently, preserving the order of ``items``
+
+        :param items: pairs of raw html and possible image path
+        :return:
+        """
+        if not items:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(items))) as executor:
+            return list(executor.map(lambda item: self.find_or_create(*item), items))
@@ -1,9 +1,18 @@
-import json
+import hashlib
+import os
 import re
-from typing import List, Tuple
-
-from bs4 import BeautifulSoup
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from pathlib import Path
+from typing import List, Tuple, Optional, Dict, Callable
+
+import lxml.html
+from lxml import etree
+import orjson
+from requests import Response
 from requests_html import HTMLSession
+from w3lib.encoding import html_body_declared_encoding
 
 from spells_bot.config import DataSourceSettings
 from spells_bot.search.sourcing.datatypes import (
@@ -46,9 +55,85 @@ SPELLS_KEY_MAP = {
     "IsRaceSpell": "is_race_spell",
 }
 
+_STRIP_ANCHOR_RE = re.compile(r"<a href[^>]*?>|</a>")
+# whitespace as defined by html, unlike str.split() it keeps &nbsp;
+_HTML_WHITESPACE_RE = re.compile("[\x20\x09\x0C\u200B\x0A\x0D]+")
+# same as "p.indent", "span.textHeader" and "h1.detailPage" css selectors,
+# compiled once since some of them run for every paragraph or table
+_INDENT_PARAGRAPH = "p[contains(concat(' ', normalize-space(@class), ' '), ' indent ')]"
+INDENT_PARAGRAPHS_XPATH = etree.XPath(f"//{_INDENT_PARAGRAPH}")
+NESTED_INDENT_PARAGRAPHS_XPATH = etree.XPath(f".//{_INDENT_PARAGRAPH}")
+TEXT_HEADER_XPATH = etree.XPath(
+    ".//span[contains(concat(' ', normalize-space(@class), ' '), ' textHeader ')]"
+)
+DETAIL_PAGE_HEADER_XPATH = etree.XPath(
+    "//h1[contains(concat(' ', normalize-space(@class), ' '), ' detailPage ')]"
+)
+TABLE_CONTENT_XPATH = etree.XPath(".//table | .//thead | .//tbody | .//tr | .//td")
+
+
+def _make_renamer(key_map: Dict[str, str]) -> Callable[[dict], dict]:
+    """Build a function which picks source keys of ``key_map`` from a dict
+    and returns them under their mapped names
+
+    :param key_map: source key to field name mapping
+    :return:
+    """
+    get_values = itemgetter(*key_map.keys())
+    names = tuple(key_map.values())
+
+    def rename(original_dict: dict) -> dict:
+        return dict(zip(names, get_values(original_dict)))
+
+    return rename
+
+
+_rename_class = _make_renamer(CLASSES_KEY_MAP)
+_rename_school = _make_renamer(SCHOOLS_KEY_MAP)
+_rename_spell = _make_renamer(SPELLS_KEY_MAP)
+
+
+def _has_class(element, class_name: str) -> bool:
+    return class_name in element.get("class", "").split()
+
+
+def _iter_text_parts(element):
+    """Yield text of an element and its descendants in document order, None for <br>
 
-def _rename_keys(original_dict, key_map):
-    return {key_map[k]: v for k, v in original_dict.items()}
+    :param element: lxml element
+    :return:
+    """
+    if element.tag == "br":
+        yield None
+    elif isinstance(element.tag, str) and element.text:
+        # comments and processing instructions have callable tags
+        yield element.text
+
+    for child in element:
+        yield from _iter_text_parts(child)
+        if child.tail:
+            yield child.tail
+
+
+def _squashed_text(element) -> str:
+    """Return text of an element with inline content collapsing html whitespace
+    and breaking lines on <br>, the same way requests_html ``.text`` does
+
+    :param element: lxml element
+    :return:
+    """
+    lines, line = [], []
+    for part in _iter_text_parts(element):
+        if part is None:
+            lines.append(line)
+            line = []
+        else:
+            line.append(part)
+    lines.append(line)
+
+    return "\n".join(
+        _HTML_WHITESPACE_RE.sub(" ", "".join(line)).strip() for line in lines
+    ).strip()
 
 
 class SourceUpdater:
@@ -59,6 +144,30 @@ class SourceUpdater:
         self.prestige_class_list_url = settings.prestige_class_list_url.rstrip("/")
         self.spell_info_url_prefix = settings.spell_info_url_prefix.rstrip("/")
         self.save_dir = save_dir
+        # parsed spell pages, reused when the database is rebuilt
+        self._spell_cache_dir = Path(save_dir) / "spell_cache" if save_dir else None
+        # shared by all scrapes to reuse pooled connections to the source
+        self._session = HTMLSession()
+
+    def close(self):
+        """Close pooled connections to the source
+
+        :return:
+        """
+        self._session.close()
+
+    @staticmethod
+    def _parse_response(response: Response) -> lxml.html.HtmlElement:
+        """Parse response body with lxml straight from bytes,
+        skipping decoding and parsing it with requests_html
+
+        :param response: page response
+        :return:
+        """
+        # same as requests_html: charset from <meta>, otherwise utf-8
+        encoding = html_body_declared_encoding(response.content) or "utf-8"
+        parser = lxml.html.HTMLParser(encoding=encoding)
+        return lxml.html.fromstring(response.content, parser=parser)
 
     @staticmethod
     def _extract_data_from_js(
@@ -67,42 +176,44 @@ class SourceUpdater:
         variable_prefix: str = None,
         variable_postfix: str = None,
     ) -> List[dict]:
-        """Strip syntax and extra characters and load data as json
+        """Cut data value out of js var declaration and load it as json
 
         :param raw_data: string with js var containing data inside its value
         :param data_type: "spells", "classes" or "schools"
-        :param variable_prefix: (optional) string before data value, defaults to "var {data_type} = \\'"
-        :param variable_postfix: (optional) string after data value, defaults to "\\';&#13;"
+        :param variable_prefix: (optional) string before data value, defaults to "var {data_type} = '"
+        :param variable_postfix: (optional) string after data value, defaults to "';"
         :return: list of dicts with data
         """
-        variable_prefix = variable_prefix or f"var {data_type} = \\'"
-        variable_postfix = variable_postfix or "\\';&#13;"
-        start, end = len(variable_prefix) - 1, -(len(variable_postfix) - 1)
+        variable_prefix = variable_prefix or f"var {data_type} = '"
+        variable_postfix = variable_postfix or "';"
+        # locate the value in place instead of stripping and copying the whole line
+        start = raw_data.find(variable_prefix) + len(variable_prefix)
+        end = raw_data.rfind(variable_postfix)
 
-        raw_json = raw_data.strip()[start:end]
-        json_data = json.loads(raw_json)
+        raw_json = raw_data[start:end]
+        json_data = orjson.loads(raw_json)
 
         return json_data
 
     @staticmethod
-    def _iter_class_extra_info(raw_data):
+    def _iter_class_extra_info(tree: lxml.html.HtmlElement):
         """Yield class name and extracted class info from one of the class lists
 
-        :param raw_data:
+        :param tree: parsed class list page
         :return:
         """
-        for p in raw_data.find("p.indent"):
+        for p in INDENT_PARAGRAPHS_XPATH(tree):
             try:
-                header = p.find("span.textHeader")[0]
-                name_html = header.find("a")[0]
-                alias = list(name_html.links)[0].split("/")[-1]
-                name = name_html.text
+                header = TEXT_HEADER_XPATH(p)[0]
+                name_html = header.xpath(".//a")[0]
+                alias = name_html.xpath("@href")[0].split("/")[-1]
+                name = _squashed_text(name_html)
 
-                sup_html = header.find("sup")[0]
-                book_alias = list(sup_html.links)[0].split("/")[-1]
-                book_abbreviation = sup_html.text
+                sup_html = header.xpath(".//sup")[0]
+                book_alias = sup_html.xpath(".//a/@href")[0].split("/")[-1]
+                book_abbreviation = _squashed_text(sup_html)
 
-                short_description = p.text.split(":")[-1]
+                short_description = _squashed_text(p).split(":")[-1]
 
                 extra_class_info = {
                     "alias": alias,
@@ -119,8 +230,8 @@ class SourceUpdater:
     def _extract_classes_from_js_and_extra_data(
         self,
         raw_classes_data: str,
-        raw_basic_class_extra_data,
-        raw_prestige_class_extra_data,
+        raw_basic_class_extra_data: lxml.html.HtmlElement,
+        raw_prestige_class_extra_data: lxml.html.HtmlElement,
     ) -> List[ClassInfo]:
         """Serialize class info from class data taken from spell list and class lists
 
@@ -143,13 +254,13 @@ class SourceUpdater:
         }
 
         for class_info in self._extract_data_from_js(raw_classes_data, "classes"):
-            class_info_kwargs = _rename_keys(class_info, CLASSES_KEY_MAP)
+            class_info_kwargs = _rename_class(class_info)
             class_name = class_info_kwargs["name"]
 
             extra_class_info_kwargs = extra_class_data_map.get(class_name, {})
             class_info_kwargs.update(extra_class_info_kwargs)
 
-            classes.append(ClassInfo(**class_info_kwargs))
+            classes.append(ClassInfo.construct(**class_info_kwargs))
 
         return classes
 
@@ -162,15 +273,16 @@ class SourceUpdater:
         schools = []
 
         for school_info in self._extract_data_from_js(raw_schools_data, "schools"):
-            school_info_kwargs = _rename_keys(school_info, SCHOOLS_KEY_MAP)
-            schools.append(SchoolInfo(**school_info_kwargs))
+            school_info_kwargs = _rename_school(school_info)
+            schools.append(SchoolInfo.construct(**school_info_kwargs))
 
         return schools
 
     def _extract_spells_from_js(
         self, raw_spell_data: str, classes: List[ClassInfo], schools: List[SchoolInfo]
     ) -> List[ShortSpellInfo]:
-        """Serialize short spell info with mapped classes and schools
+        """Serialize short spell info with mapped classes and schools.
+        Source json is trusted, so models are constructed without validation
 
         :param raw_spell_data: raw spell data
         :param classes: list of serialized ClassInfo
@@ -179,26 +291,37 @@ class SourceUpdater:
         """
         spells = []
 
-        id2class = {c.id: c for c in classes}
+        # serialized once, restrictions of every spell are built from these kwargs
+        id2class_kwargs = {c.id: c.dict() for c in classes}
         id2school = {s.id: s for s in schools}
-
-        for spell in self._extract_data_from_js(raw_spell_data, "spells"):
-            class_restrictions = []
-            for restriction in spell["ClassSpell"]:
-                class_info = id2class[restriction["ClassId"]]
-                class_info_restriction = ClassInfoSpellRestriction(
-                    **class_info.dict(), level=restriction["Level"]
+        # bound once, the loop below runs for every spell of the source
+        construct_restriction = ClassInfoSpellRestriction.construct
+        construct_spell = ShortSpellInfo.construct
+        strip_anchors = _STRIP_ANCHOR_RE.sub
+        # restrictions are read-only, spells with the same class level share one
+        restrictions = {}
+
+        def get_restriction(class_id: int, level: int) -> ClassInfoSpellRestriction:
+            key = (class_id, level)
+            if key not in restrictions:
+                restrictions[key] = construct_restriction(
+                    **id2class_kwargs[class_id], level=level
                 )
-                class_restrictions.append(class_info_restriction)
+            return restrictions[key]
 
-            spell["ClassSpell"] = class_restrictions
+        for spell in self._extract_data_from_js(raw_spell_data, "spells"):
+            spell["ClassSpell"] = [
+                get_restriction(restriction["ClassId"], restriction["Level"])
+                for restriction in spell["ClassSpell"]
+            ]
             spell["SchoolIds"] = [id2school[idx] for idx in spell["SchoolIds"]]
-            spell["ShortDescription"] = re.sub(
-                "<a href.*?>|</a>", "", spell["ShortDescription"]
-            )
+            short_description = spell["ShortDescription"]
+            # most descriptions are plain text, a substring check is cheaper than sub
+            if "<" in short_description:
+                spell["ShortDescription"] = strip_anchors("", short_description)
 
-            spell_kwargs = _rename_keys(spell, SPELLS_KEY_MAP)
-            spells.append(ShortSpellInfo(**spell_kwargs))
+            spell_kwargs = _rename_spell(spell)
+            spells.append(construct_spell(**spell_kwargs))
 
         return spells
 
@@ -207,24 +330,23 @@ class SourceUpdater:
 
         :return:
         """
-        with HTMLSession() as sess:
-            response = sess.get(self.spell_list_url)
+        response = self._session.get(self.spell_list_url)
 
-        script_with_data = response.html.find("script")[1].full_text
+        tree = self._parse_response(response)
+        script_with_data = tree.xpath("//script")[1].text_content()
         spells_raw, classes_raw, schools_raw = script_with_data.split("\n")[1:4]
 
         return spells_raw, classes_raw, schools_raw
 
-    def _collect_extra_class_data(self):
-        """Scrape class info from class and class/prestige lists
+    def _collect_extra_class_data(self, class_list_url: str) -> lxml.html.HtmlElement:
+        """Scrape class info from one of class and class/prestige lists
 
-        :return:
+        :param class_list_url: url of the class list
+        :return: parsed page
         """
-        with HTMLSession() as sess:
-            basic_classes_response = sess.get(self._settings.class_list_url)
-            prestige_classes_response = sess.get(self._settings.prestige_class_list_url)
+        response = self._session.get(class_list_url)
 
-        return basic_classes_response.html, prestige_classes_response.html
+        return self._parse_response(response)
 
     def _collect_spell_info(self, spell_alias: str) -> ExtendedSpellInfo:
         """Scrape extended spell info
@@ -232,41 +354,50 @@ class SourceUpdater:
         :param spell_alias: camelCase spell name
         :return:
         """
-        with HTMLSession() as sess:
-            response = sess.get(f"{self.spell_info_url_prefix}/{spell_alias}")
+        response = self._session.get(f"{self.spell_info_url_prefix}/{spell_alias}")
 
-        # using lxml soup to correctly parse tables, because they're mangled with <p> tags
-        soup = BeautifulSoup(response.html.html, "lxml")
+        # parsed once with libxml2 to correctly parse tables, because they're mangled with <p> tags
+        tree = self._parse_response(response)
 
-        full_name_raw = soup.find("h1", class_="detailPage").text
+        full_name_raw = DETAIL_PAGE_HEADER_XPATH(tree)[0].text_content()
         full_name = full_name_raw.strip().split("\n")[0]
         school = None
         variables = {}
         text_lines = []
         tables = []
+        table_elements = []
 
-        for table in soup.find_all("table"):
-            table = re.sub('<p class="indent">|</p>', "", str(table))
-            tables.append(SpellTable(html=table))
+        for element in tree.iter("p", "table"):
+            if element.tag == "table":
+                table_elements.append(element)
+                continue
+            if not _has_class(element, "indent"):
+                continue
 
-        for p in response.html.find("p.indent"):
-            var_header = p.find("span.textHeader")
-            table_row = p.find("table, thead, tbody, tr, td")
+            p_text = _squashed_text(element)
+            var_header = TEXT_HEADER_XPATH(element)
 
-            if p.text.startswith("Школа"):
-                school = p.text
+            if p_text.startswith("Школа"):
+                school = p_text
             elif var_header:
-                full_text_raw = p.full_text
-                var_name_raw = var_header[0].text
+                full_text_raw = element.text_content()
+                var_name_raw = _squashed_text(var_header[0])
                 var_value_raw = full_text_raw[len(var_name_raw) :]
 
                 var_name, var_value = var_name_raw.strip(" :"), var_value_raw.strip()
                 variables[var_name] = var_value
-            elif table_row:
+            elif TABLE_CONTENT_XPATH(element):
                 pass
             else:
-                if p.text:
-                    text_lines.append(p.text)
+                if p_text:
+                    text_lines.append(p_text)
+
+        # unwrapped after the walk, paragraphs inside tables are collected as text too
+        for table in table_elements:
+            for p in NESTED_INDENT_PARAGRAPHS_XPATH(table):
+                p.drop_tag()
+            table_html = lxml.html.tostring(table, encoding="unicode", with_tail=False)
+            tables.append(SpellTable(html=table_html))
 
         return ExtendedSpellInfo(
             full_name=full_name,
@@ -276,13 +407,64 @@ class SourceUpdater:
             tables=tables,
         )
 
+    def _spell_cache_path(self, spell_alias: str) -> Path:
+        """Return cache file path of extended spell info
+
+        :param spell_alias: camelCase spell name
+        :return:
+        """
+        alias_hash = hashlib.sha1(spell_alias.encode()).hexdigest()
+        return self._spell_cache_dir / f"{alias_hash}.json"
+
+    def _load_cached_spell_info(self, spell_alias: str) -> Optional[ExtendedSpellInfo]:
+        """Load extended spell info saved by ``_save_cached_spell_info``
+
+        :param spell_alias: camelCase spell name
+        :return: ExtendedSpellInfo or None if it isn't cached or can't be read
+        """
+        if not self._spell_cache_dir:
+            return None
+
+        try:
+            return ExtendedSpellInfo.parse_file(self._spell_cache_path(spell_alias))
+        except (OSError, ValueError):
+            return None
+
+    def _save_cached_spell_info(
+        self, spell_alias: str, extended_spell_info: ExtendedSpellInfo
+    ):
+        """Save extended spell info atomically, so readers never see a partial file
+
+        :param spell_alias: camelCase spell name
+        :param extended_spell_info: scraped extended spell info
+        :return:
+        """
+        if not self._spell_cache_dir:
+            return
+
+        self._spell_cache_dir.mkdir(exist_ok=True, parents=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self._spell_cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(extended_spell_info.json())
+            os.replace(tmp_path, self._spell_cache_path(spell_alias))
+        except OSError:
+            logger.exception(f"Failed to cache extended spell info for {spell_alias}")
+            Path(tmp_path).unlink(missing_ok=True)
+
     def update_spell_info(self, spell_alias: str) -> ExtendedSpellInfo:
-        """Get spell info
+        """Get spell info, scraping it only if it isn't cached in ``save_dir``
 
         :param spell_alias:
         :return:
         """
+        extended_spell_info = self._load_cached_spell_info(spell_alias)
+        if extended_spell_info:
+            logger.info(f"Loaded cached extended spell info for {spell_alias}")
+            return extended_spell_info
+
         extended_spell_info = self._collect_spell_info(spell_alias)
+        self._save_cached_spell_info(spell_alias, extended_spell_info)
 
         logger.info(f"Collected extended spell info for {spell_alias}")
         return extended_spell_info
@@ -292,11 +474,19 @@ class SourceUpdater:
 
         :return:
         """
-        spells_raw, classes_raw, schools_raw = self._collect_spell_list_js_lines()
-        (
-            basic_classes_extra_raw,
-            prestige_classes_extra_raw,
-        ) = self._collect_extra_class_data()
+        # the pages are independent, so wait for the slowest one instead of all three
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            spell_list_future = executor.submit(self._collect_spell_list_js_lines)
+            basic_classes_future = executor.submit(
+                self._collect_extra_class_data, self._settings.class_list_url
+            )
+            prestige_classes_future = executor.submit(
+                self._collect_extra_class_data, self._settings.prestige_class_list_url
+            )
+
+            spells_raw, classes_raw, schools_raw = spell_list_future.result()
+            basic_classes_extra_raw = basic_classes_future.result()
+            prestige_classes_extra_raw = prestige_classes_future.result()
 
         schools = self._extract_schools_from_js(schools_raw)
         classes = self._extract_classes_from_js_and_extra_data(
@@ -1,4 +1,5 @@
 import math
+from functools import lru_cache
 
 from spells_bot.config import (
     DatabaseSettings,
@@ -27,8 +28,12 @@ class SpellSearch:
         self.classinfo_tables_dir = storage_settings.data_root_dir / "classinfo"
         self.spell_tables_dir = storage_settings.data_root_dir / "tables"
 
-        self.source = SourceUpdater(source_settings)
+        self.source = SourceUpdater(source_settings, save_dir=self.data_root_dir)
         self.hcti = HctiApi(hcti_settings)
+
+        # class data changes only in update_sources
+        self._class_info_cached = lru_cache(maxsize=512)(self.db.get_class)
+
         self._check_db_readiness()
 
     def _check_db_readiness(self):
@@ -51,9 +56,10 @@ class SpellSearch:
     def update_sources(self):
         spells, classes, schools = self.source.update_registry()
         self.db.create_or_update_registry(spells, classes, schools)
+        self._class_info_cached.cache_clear()
 
     def short_info(self, query: str, chat_id: int, top_n: int = 10):
-        return list(self.db.iter_short_spell_info_by_name(query, chat_id))[:top_n]
+        return list(self.db.iter_short_spell_info_by_name(query, chat_id, limit=top_n))
 
     def extended_info(self, spell_alias: str):
         _, extended_spell_info = self.full_info(spell_alias)
@@ -66,11 +72,13 @@ class SpellSearch:
             try:
                 extended_spell_info = self.source.update_spell_info(spell_alias)
 
-                updated_tables = []
-                for t_idx, t in enumerate(extended_spell_info.tables):
-                    table_image_path = self.spell_tables_dir / spell_alias / f"{t_idx}.png"
-                    table = self.hcti.find_or_create(t.html, table_image_path)
-                    updated_tables.append(table)
+                spell_tables_dir = self.spell_tables_dir / spell_alias
+                updated_tables = self.hcti.find_or_create_many(
+                    [
+                        (t.html, spell_tables_dir / f"{t_idx}.png")
+                        for t_idx, t in enumerate(extended_spell_info.tables)
+                    ]
+                )
 
                 extended_spell_info = self.db.create_extended_spell_info(
                     spell_alias, extended_spell_info, updated_tables
@@ -81,7 +89,7 @@ class SpellSearch:
         return short_spell_info, extended_spell_info
 
     def class_info(self, class_id: int):
-        return self.db.get_class(class_id)
+        return self._class_info_cached(class_id)
 
     def iter_classes(self, chat_id: int):
         yield from self.db.iter_classes(chat_id)
@@ -104,8 +112,11 @@ class SpellSearch:
         page: int = 0,
         n_per_page: int = 50,
     ):
-        all_spells = list(
-            self.db.iter_short_spell_info_by_class_level(class_id, level, chat_id)
+        n_spells_total = self.db.count_short_spell_info_by_class_level(
+            class_id, level, chat_id
+        )
+        n_pages_total = math.ceil(n_spells_total / n_per_page)
+        spells = self.db.iter_short_spell_info_by_class_level(
+            class_id, level, chat_id, limit=n_per_page, offset=n_per_page * page
         )
-        n_pages_total = math.ceil(len(all_spells) / n_per_page)
-        return n_pages_total, all_spells[n_per_page * page : n_per_page * (page + 1)]
+        return n_pages_total, list(spells)
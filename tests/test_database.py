@@ -0,0 +1,74 @@
+import pytest
+
+from spells_bot.config import DatabaseSettings
+from spells_bot.search.sourcing import Database
+from spells_bot.search.sourcing.datatypes import (
+    ClassInfo,
+    ClassInfoSpellRestriction,
+    SchoolInfo,
+    ShortSpellInfo,
+)
+
+
+def test_registry_with_classes_missing_from_class_lists(tmp_path):
+    db = Database(DatabaseSettings(sqlalchemy_url=f"sqlite:///{tmp_path}/db.sqlite"))
+
+    # no class list entries, so both keep the default empty alias
+    classes = [
+        ClassInfo(id=1, name="Класс 1", parent_class_ids=[]),
+        ClassInfo(id=2, name="Класс 2", parent_class_ids=[]),
+    ]
+    schools = [SchoolInfo(id=1, name="школа", type_id=1, type_name="t")]
+    spells = [
+        ShortSpellInfo(
+            alias="fireball",
+            short_description_components="V, S",
+            book_abbreviation="CRB",
+            book_alias="coreRulebook",
+            short_description="Огненный шар",
+            name="Огненный шар",
+            is_race_spell=False,
+            schools=schools,
+            classes=[
+                ClassInfoSpellRestriction(**c.dict(), level=3) for c in classes
+            ],
+        )
+    ]
+
+    db.create_or_update_registry(spells, classes, schools)
+    db.create_or_update_registry(spells, classes, schools)
+
+    assert [db.get_class(c.id).alias for c in classes] == ["", ""]
+    (spell,) = db.iter_short_spell_info_by_name("огненный")
+    assert [c.id for c in spell.classes] == [1, 2]
+
+
+def test_update_book_filter_toggles_only_known_books(tmp_path):
+    db = Database(DatabaseSettings(sqlalchemy_url=f"sqlite:///{tmp_path}/db.sqlite"))
+    spells = [
+        ShortSpellInfo(
+            alias="fireball",
+            short_description_components="V, S",
+            book_abbreviation="CRB",
+            book_alias="coreRulebook",
+            short_description="Огненный шар",
+            name="Огненный шар",
+            is_race_spell=False,
+            schools=[],
+            classes=[],
+        )
+    ]
+    db.create_or_update_registry(spells, [], [])
+
+    # settings are created on the first toggle
+    book_filter = db.update_book_filter(1, "coreRulebook").book_filter
+    assert book_filter["coreRulebook"] is False
+    assert "coreRulebook" not in db._get_book_filter(1)
+
+    with pytest.raises(KeyError):
+        db.update_book_filter(1, "unknownBook")
+    assert db.get_or_create_chat_settings(1).book_filter == book_filter
+
+    book_filter = db.update_book_filter(1, "coreRulebook").book_filter
+    assert book_filter["coreRulebook"] is True
+    assert "coreRulebook" in db._get_book_filter(1)